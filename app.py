@@ -1,16 +1,29 @@
 import streamlit as st
 from supabase import create_client, Client
-from datetime import datetime
+from datetime import datetime, timezone
 import time
+import random
+import httpx
+from postgrest.exceptions import APIError
 import requests
+import pandas as pd
 import json
+import functools
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 
 # ---- PASSWORD GATE ----
-# No changes needed here.
 def password_gate():
+    # Once unlocked, skip the widget and the secrets lookup for the rest of the session
+    if st.session_state.get("auth_ok"):
+        return
     pw = st.text_input("Enter access password", type="password")
-    if pw != st.secrets["access_password"]:
-        st.stop()
+    if pw and hmac.compare_digest(pw.encode(), st.secrets["access_password"].encode()):
+        st.session_state["auth_ok"] = True
+        st.rerun()
+    if pw:
+        st.error("Wrong password")
+    st.stop()
 
 password_gate()
 
@@ -25,37 +38,95 @@ def init_supabase_client() -> Client:
 # Get cached client
 supabase = init_supabase_client()
 
+# PostgREST reports non-JSON gateway/rate-limit responses with the HTTP status as the
+# code, and its own 503s (PGRST000-PGRST003: database connection/pool errors) by name
+RETRYABLE_STATUS_CODES = {
+    "429", "500", "502", "503", "504",
+    "PGRST000", "PGRST001", "PGRST002", "PGRST003",
+}
+
+def execute_with_retry(query, max_attempts=5, base=0.25):
+    """Execute a Supabase read query, retrying transient failures with exponential backoff.
+
+    Only use this for reads: a write that timed out may already have been
+    applied, and retrying it could apply it twice.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return query.execute()
+        except (httpx.TransportError, APIError) as e:
+            transient = isinstance(e, httpx.TransportError) or str(e.code) in RETRYABLE_STATUS_CODES
+            if not transient or attempt == max_attempts - 1:
+                raise
+            time.sleep(base * 2 ** attempt + random.uniform(0, base))
+
 # ---- UTILITY FUNCTIONS ----
-# These functions are pure Python and require no changes.
+# Pure Python currency helpers. Coin values are coerced to int once on load
+# (see _fetch_wallet_data), so only safe_int deals with untyped input.
 def safe_int(x):
     """Convert value to int safely, returning 0 for invalid values"""
+    # Supabase hands back real ints, so that case skips the conversion entirely
+    if type(x) is int:
+        return x
+    if x is None:
+        return 0
+    if isinstance(x, str):
+        # Digit strings convert directly; anything else is invalid without raising
+        digits = x.strip()
+        unsigned = digits[1:] if digits[:1] in ("+", "-") else digits
+        return int(digits) if unsigned.isdecimal() else 0
     try:
         return int(x)
     except (ValueError, TypeError):
         return 0
 
 def convert_to_cp(platinum=0, gold=0, silver=0, copper=0):
-    """Convert currency to total copper pieces"""
-    return (
-        safe_int(platinum) * 1000 +
-        safe_int(gold) * 100 +
-        safe_int(silver) * 10 +
-        safe_int(copper)
-    )
+    """Convert currency to total copper pieces (expects ints, see _fetch_wallet_data)"""
+    return platinum * 1000 + gold * 100 + silver * 10 + copper
 
+@functools.lru_cache(maxsize=4096)
 def convert_from_cp(total_cp):
-    """Convert total copper pieces back to currency breakdown"""
-    total_cp = safe_int(total_cp)
-    return {
-        "platinum": total_cp // 1000,
-        "gold": (total_cp % 1000) // 100,
-        "silver": (total_cp % 100) // 10,
-        "copper": total_cp % 10
-    }
+    """Convert total copper pieces back to a (platinum, gold, silver, copper) tuple"""
+    platinum, rem = divmod(total_cp, 1000)
+    gold, rem = divmod(rem, 100)
+    silver, copper = divmod(rem, 10)
+    return (platinum, gold, silver, copper)
+@st.cache_resource
+def get_discord_session() -> requests.Session:
+    """Shared HTTP session so webhook posts reuse the same keep-alive connection"""
+    return requests.Session()
+
+@st.cache_resource
+def get_notification_pool() -> ThreadPoolExecutor:
+    """Background worker that delivers Discord notifications off the rerun path.
+
+    A single thread keeps notifications in submission order and means the
+    shared requests.Session is only ever used from one thread.
+    """
+    return ThreadPoolExecutor(max_workers=1)
+
+def _post_discord_webhook(session: requests.Session, webhook_url: str, data: dict):
+    """Deliver a webhook payload. Runs on the notification pool."""
+    try:
+        # Send the HTTP POST request to the webhook URL.
+        # The `json` parameter automatically handles content type headers.
+        response = session.post(webhook_url, json=data, timeout=5)
+
+        # Raise an exception if the request returned an error status (e.g., 404, 500).
+        response.raise_for_status()
+
+    except requests.exceptions.RequestException as e:
+        # This will catch any network errors (timeout, DNS, etc.).
+        # The error is printed to the console/logs for debugging.
+        print(f"Error sending Discord notification: {e}")
+
 def send_discord_notification(message: str):
     """
     Sends a message to the Discord channel via a configured webhook.
 
+    The POST itself is handed to a background thread, so a slow or
+    unreachable webhook never holds up the Streamlit rerun.
+
     Args:
         message (str): The text message to send to the Discord channel.
     """
@@ -71,100 +142,189 @@ def send_discord_notification(message: str):
     # Format the data payload as required by Discord's API.
     data = {"content": message}
 
+    # Resolve the cached resources here, on the script thread, and hand them to the worker.
+    get_notification_pool().submit(_post_discord_webhook, get_discord_session(), webhook_url, data)
+
+# ---- CACHED DATA FUNCTIONS (Refactored for Supabase) ----
+HISTORY_LIMIT = 20  # Number of recent transactions shown in the history panel
+SUMMARY_CHECK_INTERVAL = 10  # Seconds between a session's checks for other players' writes
+COINS = ("platinum", "gold", "silver", "copper")  # wallets coin columns, largest first
+# transactions column -> history table heading, in convert_from_cp order
+CHANGE_FIELDS = (
+    ("platinum_change", "Platinum"),
+    ("gold_change", "Gold"),
+    ("silver_change", "Silver"),
+    ("copper_change", "Copper"),
+)
+
+def get_party_summary():
+    """Fetch the party total in copper and the wallets version tag in one query.
+
+    Both come from the party_total_v view; the version (a digest of every
+    wallet row) is the cache key for get_wallet_data.
+    """
     try:
-        # Send the HTTP POST request to the webhook URL.
-        # The `json` parameter automatically handles content type headers.
-        response = requests.post(webhook_url, json=data, timeout=5)
+        response = execute_with_retry(supabase.table("party_total_v").select("cp, version").single())
+        return safe_int(response.data["cp"]), response.data["version"] or ""
+    except Exception as e:
+        st.error(f"Error fetching party summary: {e}")
+        return None, None
 
-        # Raise an exception if the request returned an error status (e.g., 404, 500).
-        response.raise_for_status()
+# The fetchers below are keyed on the wallets version tag, a digest of every
+# wallet row, so an entry can't go stale under its own key and is persisted to
+# disk to survive app restarts (persisted caches take no TTL). History edits made
+# outside the app don't change the tag; Refresh Data clears both caches for that.
+# They raise on failure, because exceptions aren't cached; the get_* wrappers
+# turn errors into messages.
+@st.cache_data(persist="disk", max_entries=8)
+def _fetch_wallet_data(version):
+    response = execute_with_retry(supabase.table("wallets").select(
+        "id, character_name, platinum, gold, silver, copper"
+    ).order("character_name"))
+    # Coerce coin columns to int once here so the arithmetic helpers can skip it
+    for row in response.data:
+        for coin in COINS:
+            row[coin] = safe_int(row[coin])
+    # Transform list of dicts into a dict keyed by character_name for compatibility
+    return {row["character_name"]: row for row in response.data}
 
-    except requests.exceptions.RequestException as e:
-        # This will catch any network errors (timeout, DNS, etc.).
-        # The error is printed to the console/logs for debugging.
-        print(f"Error sending Discord notification: {e}")
-        
-# ---- CACHED DATA FUNCTIONS (Refactored for Supabase) ----
-@st.cache_data(ttl=30)  # Cache for 30 seconds
-def get_wallet_data():
-    """Fetch wallet data from Supabase with caching"""
+@st.cache_data(persist="disk", max_entries=8)
+def _fetch_history(version):
+    # Fetch the latest transactions, joining character name from the 'wallets' table
+    response = execute_with_retry(supabase.table("transactions").select(
+        "created_at, description, platinum_change, gold_change, silver_change, copper_change, "
+        "wallets(character_name)"
+    ).order("created_at", desc=True).limit(HISTORY_LIMIT))
+    return response.data
+
+def get_wallet_data(version):
+    """Fetch wallet data from Supabase with caching.
+
+    `version` is the tag from get_party_summary(); it is only used as the
+    cache key, so the full table is refetched only once a wallet has changed.
+    Returns None if the fetch failed.
+    """
     try:
-        response = supabase.table("wallets").select("*").order("character_name").execute()
-        # Transform list of dicts into a dict keyed by character_name for compatibility
-        return {row["character_name"]: row for row in response.data}
+        return _fetch_wallet_data(version)
     except Exception as e:
         st.error(f"Error fetching wallet data: {e}")
-        return {}
+        return None
 
-@st.cache_data(ttl=60)  # Cache history for 1 minute
-def get_history():
-    """Fetch recent transaction history from Supabase with caching"""
+def get_history(version):
+    """Fetch recent transaction history from Supabase with caching.
+
+    Every transaction also updates a wallet, so the wallets version tag
+    changes whenever new history exists and works as the cache key here too.
+    Returns None if the fetch failed.
+    """
     try:
-        # Fetch last 20 transactions, joining character name from the 'wallets' table
-        response = supabase.table("transactions").select(
-            "*, wallets(character_name)"
-        ).order("created_at", desc=True).limit(20).execute()
-        return response.data
+        return _fetch_history(version)
     except Exception as e:
         st.error(f"Error fetching history: {e}")
-        return []
+        return None
+
+def update_wallet_supabase(character_wallet, change_cp, label):
+    """Apply a transaction through the apply_txn RPC (see sql/03_apply_txn.sql).
+
+    The funds check, transaction log insert and wallet update all run inside
+    one Postgres transaction, so concurrent players can't overwrite each
+    other's balances and a submit costs a single round trip.
+    """
+    # Don't spend a write (and log an all-zero transaction) on a no-op
+    if change_cp == 0:
+        st.error("Please enter an amount for the transaction.")
+        return None
 
-def update_wallet_supabase(character_wallet, change_cp, label, txn_type):
-    """Update wallet and log transaction in Supabase."""
     try:
-        # --- Step 1: Check for sufficient funds ---
-        current_cp = convert_to_cp(
-            character_wallet["platinum"],
-            character_wallet["gold"],
-            character_wallet["silver"],
-            character_wallet["copper"]
-        )
-        if current_cp + change_cp < 0:
-            st.error("Insufficient funds for this transaction.")
-            return None # MODIFIED: Return None on failure
-
-        # --- Step 2: Log the immutable transaction event. ---
-        # Deconstruct the change from total copper into constituent coins
-        change_amounts = convert_from_cp(abs(change_cp))
-        
-        supabase.table("transactions").insert({
-            "character_id": character_wallet['id'], # The Foreign Key
-            "description": label,
-            "platinum_change": change_amounts['platinum'] if txn_type == "Add" else -change_amounts['platinum'],
-            "gold_change": change_amounts['gold'] if txn_type == "Add" else -change_amounts['gold'],
-            "silver_change": change_amounts['silver'] if txn_type == "Add" else -change_amounts['silver'],
-            "copper_change": change_amounts['copper'] if txn_type == "Add" else -change_amounts['copper'],
+        response = supabase.rpc("apply_txn", {
+            "character_id": character_wallet['id'],
+            "change_cp": change_cp,
+            "label": label,
         }).execute()
-        
-        # --- Step 3: Update the character's wallet summary. ---
-        new_total_cp = current_cp + change_cp
-        new_balance = convert_from_cp(new_total_cp)
-
-        supabase.table("wallets").update({
-            "platinum": new_balance["platinum"],
-            "gold": new_balance["gold"],
-            "silver": new_balance["silver"],
-            "copper": new_balance["copper"],
-        }).eq("id", character_wallet['id']).execute()
-
-        get_wallet_data.clear()
-        get_history.clear()
-        
-        return new_balance # MODIFIED: Return the new_balance dictionary on success
-        
     except Exception as e:
         st.error(f"Error updating wallet: {e}")
-        return None # MODIFIED: Return None on failure
+        return None
+
+    # apply_txn returns no rows when the balance would go negative
+    if not response.data:
+        st.error("Insufficient funds for this transaction.")
+        return None
+
+    # From here on the transaction is committed. Nothing below may report the
+    # write as failed, or the user would resubmit and apply it twice.
+    result = response.data[0]
+    new_balance = {coin: result[coin] for coin in COINS}
+    # Check the summary on the run right after a write, whatever the throttle says
+    st.session_state.pop("summary_checked_at", None)
+
+    try:
+        if result["version_before"] == st.session_state.get("wallets_version"):
+            # Nobody else wrote since this session's copy was taken, so applying
+            # the change in place brings it exactly to version_after: the next
+            # run finds the versions equal and doesn't refetch anything.
+            character_wallet.update(new_balance)
+            st.session_state["wallets_version"] = result["version_after"]
+            st.session_state["party_total_cp"] += change_cp
+            if "history" in st.session_state:
+                sign = -1 if change_cp < 0 else 1
+                change_row = {
+                    field: sign * amount
+                    for (field, _), amount in zip(CHANGE_FIELDS, convert_from_cp(abs(change_cp)))
+                }
+                st.session_state["history"] = [{
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "description": label,
+                    **change_row,
+                    "wallets": {"character_name": character_wallet["character_name"]},
+                }] + st.session_state["history"][:HISTORY_LIMIT - 1]
+        else:
+            # The copy was already behind other players' writes; reload it next run
+            st.session_state.pop("wallets_version", None)
+    except Exception as e:
+        # e.g. an older apply_txn without the version columns. The copy may be
+        # half-patched, so have the next run reload it from the database.
+        print(f"Error patching session data after apply_txn: {e}")
+        st.session_state.pop("wallets_version", None)
+
+    return new_balance
 
 # ---- UI (with minor adjustments) ----
 st.title("⚔️ D&D Party Wallet Tracker")
 
+if flash := st.session_state.pop("flash", None):
+    st.success(flash)
+
 if st.button("🔄 Refresh Data"):
-    get_wallet_data.clear()
-    get_history.clear()
+    # Bypass the shared caches too: the version tag only tracks wallets, so
+    # transactions edited outside the app would otherwise stay hidden
+    _fetch_wallet_data.clear()
+    _fetch_history.clear()
+    for key in ("wallets", "wallets_version", "history", "party_total_cp", "summary_checked_at"):
+        st.session_state.pop(key, None)
     st.rerun()
 
-data = get_wallet_data()
+# Each session keeps its own copy of the data. At most every SUMMARY_CHECK_INTERVAL
+# seconds (and always right after a submit or Refresh, which clear the timestamp)
+# a full run checks the party summary and reloads the copy only when the wallets
+# have changed since it was taken; update_wallet_supabase keeps it current after
+# this session's own writes. The throttle lives in session state rather than a
+# shared cache so a session never sees a summary older than its own last write.
+now = time.monotonic()
+if (
+    "wallets" not in st.session_state
+    or now - st.session_state.get("summary_checked_at", float("-inf")) >= SUMMARY_CHECK_INTERVAL
+):
+    st.session_state["summary_checked_at"] = now
+    party_total_cp, wallets_version = get_party_summary()
+    if wallets_version is not None and wallets_version != st.session_state.get("wallets_version"):
+        wallets = get_wallet_data(wallets_version)
+        if wallets is not None:
+            st.session_state["wallets"] = wallets
+            st.session_state["wallets_version"] = wallets_version
+            st.session_state["party_total_cp"] = party_total_cp
+            # History shares the version; drop it so the history panel reloads it
+            st.session_state.pop("history", None)
+data = st.session_state.get("wallets")
 if not data:
     st.warning("No character data found. Check your Supabase connection and tables.")
     st.stop()
@@ -210,12 +370,10 @@ if character_name:
                 # --- END OF MISSING LINES ---
             
                 # Now, call the update function with the correctly calculated change_cp
-                final_balance = update_wallet_supabase(wallet, change_cp, label.strip(), txn_type)
+                final_balance = update_wallet_supabase(wallet, change_cp, label.strip())
             
                 # This 'if' checks if the update was successful
                 if final_balance:
-                    st.success("Transaction successful!")
-
                     currency_str = f"{platinum}p, {gold}g, {silver}s, {copper}c"
                     final_balance_str = f"{final_balance['platinum']}p, {final_balance['gold']}g, {final_balance['silver']}s, {final_balance['copper']}c"
 
@@ -225,39 +383,51 @@ if character_name:
                         f"The new balance is `{final_balance_str}`.\n The ledgers are balanced."
                     )
                     send_discord_notification(notification_message)
-                    time.sleep(0.5)
+                    # Shown at the top of the next run, so there's no need to sleep before rerunning
+                    st.session_state["flash"] = "Transaction successful!"
                     st.rerun()
 
 # ---- PARTY TOTAL ----
-st.markdown("---")
-st.subheader("🏰 Party Total Wealth")
-try:
-    total_cp = sum(convert_to_cp(**{k.lower(): v for k, v in row.items() if k.lower() in ['platinum', 'gold', 'silver', 'copper']}) for row in data.values())
-    total = convert_from_cp(total_cp)
-    
-    col1, col2, col3, col4 = st.columns(4)
-    col1.metric("Platinum", total['platinum'])
-    col2.metric("Gold", total['gold'])
-    col3.metric("Silver", total['silver'])
-    col4.metric("Copper", total['copper'])
-except Exception as e:
-    st.error(f"Error calculating party total: {e}")
+def render_party_total():
+    st.markdown("---")
+    st.subheader("🏰 Party Total Wealth")
+    party_total_cp = st.session_state["party_total_cp"]
+    if party_total_cp is not None:
+        total_platinum, total_gold, total_silver, total_copper = convert_from_cp(party_total_cp)
+
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Platinum", total_platinum)
+        col2.metric("Gold", total_gold)
+        col3.metric("Silver", total_silver)
+        col4.metric("Copper", total_copper)
 
 # ---- TRANSACTION HISTORY ----
-st.markdown("---")
-st.subheader("📜 Recent Transaction History")
-if st.checkbox("Show Transaction History", value=True):
-    history = get_history()
-    if history:
-        for row in history:
-            # The structure of 'row' is now much cleaner
-            char_name = row['wallets']['character_name'] if row.get('wallets') else 'Unknown'
-            change_str = ", ".join([f"{v} {k.split('_')[0]}" for k, v in row.items() if 'change' in k and v != 0])
-            
-            st.markdown(f"""
-            **{datetime.fromisoformat(row['created_at']).strftime('%Y-%m-%d %H:%M')}** - **{char_name}**: {row['description']}
-            
-            *Change: {change_str}*
-            """)
-    else:
-        st.info("No transaction history found.")
+# A fragment, so toggling the checkbox reruns only this panel rather than the whole page
+@st.fragment
+def render_history():
+    st.markdown("---")
+    st.subheader("📜 Recent Transaction History")
+    if st.checkbox("Show Transaction History", value=True):
+        # Only a successful fetch is kept, so a failure is retried on the next run
+        # and an empty history (a new campaign) is not refetched every time.
+        if "history" not in st.session_state:
+            history = get_history(st.session_state.get("wallets_version"))
+            if history is not None:
+                st.session_state["history"] = history
+        history = st.session_state.get("history")
+        if history:
+            # One table instead of a markdown block per row: a single message to the browser
+            history_df = pd.DataFrame(history)
+            history_df["Time"] = [datetime.fromisoformat(row['created_at']).strftime('%Y-%m-%d %H:%M') for row in history]
+            history_df["Character"] = [row['wallets']['character_name'] if row.get('wallets') else 'Unknown' for row in history]
+            history_df = history_df.rename(columns={"description": "Description", **dict(CHANGE_FIELDS)})
+            st.dataframe(
+                history_df[["Time", "Character", "Description", *(heading for _, heading in CHANGE_FIELDS)]],
+                hide_index=True,
+                width="stretch",
+            )
+        elif history is not None:
+            st.info("No transaction history found.")
+
+render_party_total()
+render_history()
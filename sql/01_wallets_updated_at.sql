@@ -0,0 +1,21 @@
+-- Migrations in this directory are applied in filename order.
+--
+-- Track when each wallet last changed. updated_at feeds the version tag
+-- exposed by party_total_v (02) and read by the app's get_party_summary().
+alter table wallets
+    add column if not exists updated_at timestamptz not null default now();
+
+create or replace function wallets_touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists wallets_touch_updated_at on wallets;
+create trigger wallets_touch_updated_at
+    before update on wallets
+    for each row execute function wallets_touch_updated_at();
@@ -0,0 +1,13 @@
+-- Party-wide wealth in copper pieces, summed by Postgres so the app can
+-- fetch a single number instead of totalling every wallet row itself.
+-- `version` is a digest of every wallet row (see 01_wallets_updated_at.sql,
+-- which must run first), returned alongside so one request also yields the
+-- wallet cache key. Hashing the rows rather than taking max(updated_at)
+-- means a late-committing transaction or a deleted wallet still changes it.
+create or replace view party_total_v as
+select coalesce(sum(platinum * 1000 + gold * 100 + silver * 10 + copper), 0)::bigint as cp,
+       md5(coalesce(string_agg(
+           concat_ws(':', id, character_name, platinum, gold, silver, copper, updated_at),
+           ',' order by id
+       ), '')) as version
+  from wallets;
@@ -0,0 +1,72 @@
+-- Atomically apply a currency change to a character's wallet.
+--
+-- Takes a lock that serializes wallet writers, rejects the change if it
+-- would leave the balance negative, logs the transaction and writes the
+-- new balance in a single database transaction. Returns the new balance
+-- together with the party_total_v version tag from just before and just
+-- after the write, or no rows when the wallet has insufficient funds.
+-- Because writers are serialized, version_before -> version_after is
+-- exactly this transaction's change, which lets the app patch its copy
+-- in place when it already holds version_before.
+
+-- The return type changed, which `create or replace` can't do on its own.
+drop function if exists apply_txn(bigint, bigint, text);
+
+create function apply_txn(character_id bigint, change_cp bigint, label text)
+returns table (
+    platinum bigint, gold bigint, silver bigint, copper bigint,
+    version_before text, version_after text
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+    current_cp bigint;
+    new_cp bigint;
+    change_abs bigint := abs(apply_txn.change_cp);
+    change_sign bigint := case when apply_txn.change_cp < 0 then -1 else 1 end;
+    old_version text;
+begin
+    -- Self-conflicting mode: other writers wait, plain reads carry on.
+    lock table wallets in share row exclusive mode;
+
+    select v.version into old_version from party_total_v v;
+
+    select w.platinum * 1000 + w.gold * 100 + w.silver * 10 + w.copper
+      into current_cp
+      from wallets w
+     where w.id = apply_txn.character_id;
+
+    if not found then
+        raise exception 'No wallet with id %', apply_txn.character_id;
+    end if;
+
+    new_cp := current_cp + apply_txn.change_cp;
+    if new_cp < 0 then
+        return;
+    end if;
+
+    insert into transactions (
+        character_id, description,
+        platinum_change, gold_change, silver_change, copper_change
+    ) values (
+        apply_txn.character_id, apply_txn.label,
+        change_sign * (change_abs / 1000),
+        change_sign * (change_abs % 1000 / 100),
+        change_sign * (change_abs % 100 / 10),
+        change_sign * (change_abs % 10)
+    );
+
+    update wallets w
+       set platinum = new_cp / 1000,
+           gold = new_cp % 1000 / 100,
+           silver = new_cp % 100 / 10,
+           copper = new_cp % 10
+     where w.id = apply_txn.character_id;
+
+    return query
+    select new_cp / 1000, new_cp % 1000 / 100, new_cp % 100 / 10, new_cp % 10,
+           old_version, v.version
+      from party_total_v v;
+end;
+$$;
@@ -0,0 +1,4 @@
+-- Lets get_history's "order by created_at desc limit 20" read the newest
+-- rows straight off the index instead of sorting the whole ledger.
+create index if not exists transactions_created_at_idx
+    on transactions (created_at desc);